@@ -6,26 +6,31 @@ from __future__ import annotations
 import argparse
 import datetime as dt
 import hashlib
+import heapq
 import json
 import os
 import random
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass, fields
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
 from db import (
-    compute_dom_days,
-    compute_price_drop_30d,
-    detect_relist,
+    compute_signals_batch,
     init_db,
+    load_current_map,
     mark_missing,
-    mark_seen,
-    record_event,
+    record_events,
+    record_presence,
     signature_for,
     upsert_listing_current,
 )
 from fetch_public import fetch_listings
 
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is used as a fallback
+    orjson = None
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 CONFIG_PATH = BASE_DIR / "config" / "settings.json"
 DB_PATH = BASE_DIR / "data" / "app.sqlite"
@@ -50,8 +55,19 @@ DEFAULT_SETTINGS = {
 
 PROPERTY_TYPES = ["Condo", "Townhouse", "Detached", "1/2 Duplex"]
 
+CITY_BASE_PRICES = {
+    "Vancouver": 1100000,
+    "Burnaby": 950000,
+    "Richmond": 980000,
+    "Surrey": 780000,
+    "Coquitlam": 820000,
+    "North Vancouver": 1050000,
+}
+
+PTYPE_MULT = {"Condo": 0.72, "Townhouse": 0.86}
+
 
-@dataclass
+@dataclass(slots=True)
 class Listing:
     listing_id: str
     source: str
@@ -65,7 +81,10 @@ class Listing:
     sqft: Optional[int] = None
     description: str = ""
     bc_assessed_value: Optional[int] = None
-    notes: str = ""
+    notes: str = ""
+
+
+_LISTING_FIELDS = tuple(f.name for f in fields(Listing))
 
 
 def now_iso(ts: Optional[dt.datetime] = None) -> str:
@@ -79,8 +98,12 @@ def stable_id(*parts: str) -> str:
 
 def safe_write_json(path: str, data) -> None:
     tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
     os.replace(tmp, path)
 
 
@@ -107,26 +130,18 @@ def generate_demo_listings(settings: Dict, n: int = 200) -> List[Listing]:
     cities = settings.get("target_cities") or DEFAULT_SETTINGS["target_cities"]
     rng = random.Random(dt.datetime.utcnow().date().toordinal())
     out: List[Listing] = []
+    # Draw the categorical columns for the whole batch up front.
+    beds_col = rng.choices([1, 2, 3, 4, 5], k=n)
+    baths_col = rng.choices([1, 1.5, 2, 2.5, 3], k=n)
     for i in range(n):
         city = cities[i % len(cities)]
         ptype = PROPERTY_TYPES[i % len(PROPERTY_TYPES)]
-        beds = rng.choice([1, 2, 3, 4, 5])
-        baths = rng.choice([1, 1.5, 2, 2.5, 3])
+        beds = beds_col[i]
+        baths = baths_col[i]
         sqft = rng.randint(450, 3200)
 
-        base_price = {
-            "Vancouver": 1100000,
-            "Burnaby": 950000,
-            "Richmond": 980000,
-            "Surrey": 780000,
-            "Coquitlam": 820000,
-            "North Vancouver": 1050000,
-        }.get(city, 900000)
-
-        if ptype == "Condo":
-            base_price = int(base_price * 0.72)
-        elif ptype == "Townhouse":
-            base_price = int(base_price * 0.86)
+        base_price = CITY_BASE_PRICES.get(city, 900000)
+        base_price = int(base_price * PTYPE_MULT.get(ptype, 1.0))
 
         drift = rng.uniform(0.78, 1.22)
         price = int(base_price * drift)
@@ -217,27 +232,44 @@ def load_seed_listings(seed_path: Path) -> List[Listing]:
     return out
 
 
-def keyword_hits(text: str, settings: Dict) -> List[str]:
-    t = (text or "").lower()
-    hits = []
-    for k in settings.get("signals", {}).get("motivated_keywords_en", []):
-        if k.lower() in t:
-            hits.append(k)
-    for k in settings.get("signals", {}).get("motivated_keywords_zh", []):
-        if k in (text or ""):
-            hits.append(k)
+@dataclass(frozen=True)
+class Thresholds:
+    """Signal settings resolved once per run instead of once per listing."""
+
+    ratio_thresh: float
+    drop_thresh: float
+    dom_thresh: int
+    kw_en: Tuple[Tuple[str, str], ...]  # (keyword, keyword.lower())
+    kw_zh: Tuple[str, ...]
+
+
+def build_thresholds(settings: Dict) -> Thresholds:
+    signals_cfg = settings.get("signals", {})
+    defaults = DEFAULT_SETTINGS["signals"]
+    return Thresholds(
+        ratio_thresh=float(signals_cfg.get("below_assessed_ratio", defaults["below_assessed_ratio"])),
+        drop_thresh=float(signals_cfg.get("price_drop_ratio_30d", defaults["price_drop_ratio_30d"])),
+        dom_thresh=int(signals_cfg.get("dom_days", defaults["dom_days"])),
+        kw_en=tuple((k, k.lower()) for k in signals_cfg.get("motivated_keywords_en", [])),
+        kw_zh=tuple(signals_cfg.get("motivated_keywords_zh", [])),
+    )
+
+
+def keyword_hits(text: str, thresholds: Thresholds) -> List[str]:
+    raw = text or ""
+    t = raw.lower()
+    hits = [k for k, k_lower in thresholds.kw_en if k_lower in t]
+    hits.extend(k for k in thresholds.kw_zh if k in raw)
     return hits
 
 
-def evaluate_listing(listing: Dict, dom_days: Optional[int], price_drop_ratio: float, is_relist: bool, hits: List[str], settings: Dict) -> Tuple[float, List[str], Dict]:
-    signals_cfg = settings.get("signals", {})
+def evaluate_listing(listing: Dict, dom_days: Optional[int], price_drop_ratio: float, is_relist: bool, hits: List[str], thresholds: Thresholds) -> Tuple[float, List[str], Dict]:
     reasons: List[str] = []
     score = 0.0
 
     price = listing.get("price") or 0
     assessed = listing.get("bc_assessed_value") or listing.get("assessed")
     missing_price = price <= 0
-    ratio_thresh = float(signals_cfg.get("below_assessed_ratio", DEFAULT_SETTINGS["signals"]["below_assessed_ratio"]))
     is_below_assessed = False
     if missing_price:
         reasons.append("Missing price")
@@ -245,18 +277,17 @@ def evaluate_listing(listing: Dict, dom_days: Optional[int], price_drop_ratio: f
     if assessed and price > 0:
         ratio = price / max(1, assessed)
         gap = max(0.0, 1 - ratio)
-        if ratio <= ratio_thresh:
+        if ratio <= thresholds.ratio_thresh:
             is_below_assessed = True
             score += gap * 220
             reasons.append(f"低于评估价 {gap*100:.0f}%")
 
-    drop_thresh = float(signals_cfg.get("price_drop_ratio_30d", DEFAULT_SETTINGS["signals"]["price_drop_ratio_30d"]))
-    is_price_drop = price_drop_ratio >= drop_thresh
+    is_price_drop = price_drop_ratio >= thresholds.drop_thresh
     if is_price_drop:
         score += price_drop_ratio * 140
         reasons.append(f"近30天下降 {price_drop_ratio*100:.0f}%")
 
-    dom_thresh = int(signals_cfg.get("dom_days", DEFAULT_SETTINGS["signals"]["dom_days"]))
+    dom_thresh = thresholds.dom_thresh
     is_long_dom = dom_days is not None and dom_days >= dom_thresh
     if is_long_dom:
         score += min(dom_days / max(1, dom_thresh), 2.0) * 60
@@ -282,45 +313,58 @@ def evaluate_listing(listing: Dict, dom_days: Optional[int], price_drop_ratio: f
 
 def enrich_listings(listings: List[Dict], settings: Dict, conn) -> List[Dict]:
     now = dt.datetime.utcnow()
+    now_str = now_iso(now)
     seen_ids = set()
     enriched: List[Dict] = []
 
-    cur = conn.cursor()
-    cur.execute("SELECT listing_id FROM listings_current WHERE is_active=1;")
-    previously_active = {row[0] for row in cur.fetchall()}
-
-    for raw in listings:
-        payload = dict(raw)
-        payload["signature"] = signature_for(payload)
-        result = upsert_listing_current(conn, payload, now)
+    current_map = load_current_map(conn)
+    previously_active = {lid for lid, row in current_map.items() if row["is_active"] == 1}
+    thresholds = build_thresholds(settings)
 
-        if result.get("price_changed"):
-            record_event(conn, payload["listing_id"], "price_change", result.get("old_price"), payload.get("price"), now)
-
-        mark_seen(conn, payload["listing_id"], now)
-
-        dom_days = compute_dom_days(conn, payload["listing_id"], now) or 0
-        price_drop_ratio = compute_price_drop_30d(conn, payload["listing_id"], now)
-        is_relist = detect_relist(conn, payload["listing_id"], now)
-        hits = keyword_hits(payload.get("description", ""), settings)
-
-        score, reasons, signal_flags = evaluate_listing(payload, dom_days, price_drop_ratio, is_relist, hits, settings)
-        enriched.append(
-            {
-                **payload,
-                "dom_days": dom_days,
-                "price_drop_30d_ratio": price_drop_ratio,
-                "is_relist": bool(is_relist),
-                "reasons": reasons,
-                "score": score,
+    # The db helpers do not commit; the whole pass is written as one transaction.
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        payloads: List[Dict] = []
+        events: List[Tuple] = []
+        for raw in listings:
+            payload = dict(raw)
+            payload["signature"] = signature_for(payload)
+            result = upsert_listing_current(conn, payload, current_map, now_str)
+
+            if result.get("price_changed"):
+                events.append((payload["listing_id"], "price_change", result.get("old_price"), payload.get("price")))
+            payloads.append(payload)
+
+        listing_ids = [p["listing_id"] for p in payloads]
+        record_events(conn, events, now_str)
+        record_presence(conn, listing_ids, now_str)
+
+        signals = compute_signals_batch(conn, current_map, listing_ids, now)
+
+        for payload in payloads:
+            dom_days, price_drop_ratio, is_relist = signals[payload["listing_id"]]
+            hits = keyword_hits(payload.get("description", ""), thresholds)
+
+            score, reasons, signal_flags = evaluate_listing(payload, dom_days, price_drop_ratio, is_relist, hits, thresholds)
+            # payload is already our own copy of raw; enrich it in place.
+            payload.update(
+                dom_days=dom_days,
+                price_drop_30d_ratio=price_drop_ratio,
+                is_relist=bool(is_relist),
+                reasons=reasons,
+                score=score,
                 **signal_flags,
-            }
-        )
-        seen_ids.add(payload["listing_id"])
+            )
+            enriched.append(payload)
+            seen_ids.add(payload["listing_id"])
 
-    missing_ids = previously_active - seen_ids
-    for mid in missing_ids:
-        mark_missing(conn, mid, now)
+        missing_ids = previously_active - seen_ids
+        for mid in missing_ids:
+            mark_missing(conn, mid, now_str)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
 
     return enriched
 
@@ -329,7 +373,7 @@ def build_outputs(listings: List[Dict], top_k: int = 50):
     deals = []
     alerts = []
 
-    scored = sorted(listings, key=lambda x: x.get("score", 0), reverse=True)
+    scored = heapq.nlargest(max(top_k, 10), listings, key=lambda x: x.get("score", 0))
 
     for x in scored[:top_k]:
         deals.append(
@@ -384,7 +428,8 @@ def fetch_live(source: str, settings: Dict) -> List[Listing]:
 def to_dict_list(listings: List[Listing]) -> List[Dict]:
     out: List[Dict] = []
     for l in listings:
-        out.append(asdict(l) if isinstance(l, Listing) else dict(l))
+        # Listing fields are flat scalars, so skip asdict's recursive deepcopy.
+        out.append({name: getattr(l, name) for name in _LISTING_FIELDS} if isinstance(l, Listing) else dict(l))
     return out
 
 
@@ -417,10 +462,11 @@ def main() -> int:
     out_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
     os.makedirs(out_dir, exist_ok=True)
 
-    safe_write_json(os.path.join(out_dir, "alerts.json"), {"generated_at": now_iso(), "alerts": alerts})
-    safe_write_json(os.path.join(out_dir, "top_deals.json"), {"generated_at": now_iso(), "deals": deals})
+    generated_at = now_iso()
+    safe_write_json(os.path.join(out_dir, "alerts.json"), {"generated_at": generated_at, "alerts": alerts})
+    safe_write_json(os.path.join(out_dir, "top_deals.json"), {"generated_at": generated_at, "deals": deals})
     safe_write_json(os.path.join(out_dir, "last_run.json"), {
-        "generated_at": now_iso(),
+        "generated_at": generated_at,
         "mode": args.mode,
         "listing_count": len(listings),
         "alert_count": len(alerts),
@@ -3,50 +3,79 @@
 from __future__ import annotations
 
 import datetime as dt
+import functools
 import hashlib
 import os
 import sqlite3
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 
+# A datetime, or a string already formatted by _iso (lets a batch format "now" once).
+Timestamp = Union[dt.datetime, str]
 
-def _iso(ts: Optional[dt.datetime] = None) -> str:
+
+def _iso(ts: Optional[Timestamp] = None) -> str:
+    if isinstance(ts, str):
+        return ts
     ts = ts or dt.datetime.utcnow()
     return ts.replace(microsecond=0).isoformat() + "Z"
 
 
+def _parse_iso_fast(ts: str) -> dt.datetime:
+    """Parse the fixed YYYY-MM-DDTHH:MM:SS layout written by _iso."""
+    return dt.datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+
+
+@functools.lru_cache(maxsize=2048)
 def _parse_iso(ts: Optional[str]) -> Optional[dt.datetime]:
     if not ts:
         return None
     ts = ts.rstrip("Z")
+    if len(ts) == 19 and ts[10] == "T":
+        try:
+            return _parse_iso_fast(ts)
+        except ValueError:
+            pass
     try:
         return dt.datetime.fromisoformat(ts)
     except ValueError:
         return None
 
 
+@functools.lru_cache(maxsize=4096)
 def _normalize_text(val: Optional[str]) -> str:
     if not val:
         return ""
     return " ".join(val.lower().split())
 
 
+def _number_text(val) -> str:
+    # REAL columns hand back 2.0 for a stored 2; format both the same way.
+    if not val:
+        return ""
+    if isinstance(val, float) and val.is_integer():
+        val = int(val)
+    return str(val)
+
+
 def signature_for(listing: Dict) -> str:
     """Create a property signature for relist detection."""
     parts = [
         _normalize_text(listing.get("address")),
         _normalize_text(listing.get("city")),
-        str(listing.get("beds") or ""),
-        str(listing.get("baths") or ""),
-        str(listing.get("sqft") or ""),
+        _number_text(listing.get("beds")),
+        _number_text(listing.get("baths")),
+        _number_text(listing.get("sqft")),
     ]
     raw = "||".join(parts)
-    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
 
 
 def init_db(db_path: str) -> sqlite3.Connection:
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     conn = sqlite3.connect(db_path)
     conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS listings_current(
@@ -61,7 +90,7 @@ def init_db(db_path: str) -> sqlite3.Connection:
             baths REAL,
             sqft INT,
             assessed INT,
-            desc_hash TEXT,
+            desc_hash TEXT,  -- no longer written; kept for existing databases
             first_seen TEXT,
             last_seen TEXT,
             is_active INT,
@@ -90,199 +119,273 @@ def init_db(db_path: str) -> sqlite3.Connection:
         );
         """
     )
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_listing ON listing_events(listing_id);")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_time ON listing_events(event_time);")
+    has_prices = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='listing_prices';").fetchone()
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS listing_prices(
+            listing_id TEXT,
+            ts TEXT,
+            price REAL
+        );
+        """
+    )
     conn.execute("CREATE INDEX IF NOT EXISTS idx_presence_listing ON listing_presence(listing_id);")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_signature ON listings_current(signature);")
+    # Serves the per-run event_type scans in compute_signals_batch as covering index seeks.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_type_lid_time ON listing_events(event_type, listing_id, event_time);")
+    # Superseded or readerless since signals are computed from load_current_map.
+    for stale in ("idx_events_listing", "idx_events_time", "idx_signature"):
+        conn.execute(f"DROP INDEX IF EXISTS {stale};")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_prices_lid_ts ON listing_prices(listing_id, ts);")
+    if not has_prices:
+        _backfill_listing_prices(conn)
+        conn.commit()
+    if _resign_legacy_signatures(conn):
+        conn.commit()
     return conn
 
 
-def upsert_listing_current(conn: sqlite3.Connection, listing: Dict, seen_time: Optional[dt.datetime] = None) -> Dict:
+def _resign_legacy_signatures(conn: sqlite3.Connection) -> int:
+    """Recompute 40-hex SHA-1 signatures from older databases with signature_for.
+
+    All signature inputs are stored on the row, so inactive listings keep
+    matching relisted ones after the hash change.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT listing_id, address, city, beds, baths, sqft FROM listings_current WHERE length(signature)=40;")
+    updates = [
+        (signature_for({"address": address, "city": city, "beds": beds, "baths": baths, "sqft": sqft}), listing_id)
+        for listing_id, address, city, beds, baths, sqft in cur.fetchall()
+    ]
+    if updates:
+        conn.executemany("UPDATE listings_current SET signature=? WHERE listing_id=?;", updates)
+    return len(updates)
+
+
+def _backfill_listing_prices(conn: sqlite3.Connection) -> None:
+    """Seed listing_prices for a database created before the table existed.
+
+    Each listing gets its original price at first_seen (the old_value of its
+    earliest price_change, or its current price if it never changed) plus one
+    row per recorded price_change.
+    """
+    conn.execute(
+        """
+        INSERT INTO listing_prices(listing_id, ts, price)
+        SELECT listing_id, event_time, CAST(new_value AS REAL) FROM listing_events
+        WHERE event_type='price_change' AND new_value NOT IN ('None', '');
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO listing_prices(listing_id, ts, price)
+        SELECT c.listing_id, c.first_seen, CAST(e.old_value AS REAL)
+        FROM listings_current c
+        JOIN listing_events e ON e.id = (
+            SELECT id FROM listing_events
+            WHERE listing_id=c.listing_id AND event_type='price_change'
+            ORDER BY event_time ASC, id ASC LIMIT 1
+        )
+        WHERE e.old_value NOT IN ('None', '');
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO listing_prices(listing_id, ts, price)
+        SELECT listing_id, first_seen, price FROM listings_current
+        WHERE price IS NOT NULL
+          AND listing_id NOT IN (SELECT listing_id FROM listing_events WHERE event_type='price_change');
+        """
+    )
+
+
+def load_current_map(conn: sqlite3.Connection) -> Dict[str, Dict]:
+    """Load listings_current once, keyed by listing_id, for a batch pass."""
+    cur = conn.cursor()
+    cur.execute("SELECT listing_id, price, first_seen, signature, is_active, last_seen FROM listings_current;")
+    return {
+        listing_id: {
+            "price": price,
+            "first_seen": first_seen,
+            "signature": signature,
+            "is_active": is_active,
+            "last_seen": last_seen,
+        }
+        for listing_id, price, first_seen, signature, is_active, last_seen in cur.fetchall()
+    }
+
+
+def upsert_listing_current(conn: sqlite3.Connection, listing: Dict, current_map: Dict[str, Dict], seen_time: Optional[Timestamp] = None) -> Dict:
+    """Insert or update a listing, reading the previous row from current_map and keeping it in sync."""
     seen = _iso(seen_time)
     listing_id = listing["listing_id"]
     signature = listing.get("signature") or signature_for(listing)
-    desc_hash = hashlib.sha1((listing.get("description") or "").encode("utf-8")).hexdigest()
 
     cur = conn.cursor()
-    cur.execute("SELECT price, is_active FROM listings_current WHERE listing_id=?", (listing_id,))
-    row = cur.fetchone()
+    cached = current_map.get(listing_id)
 
     old_price = None
     price_changed = False
+    first_seen = seen
 
-    if row:
-        old_price, _is_active = row
+    if cached:
+        old_price, first_seen = cached["price"], cached["first_seen"]
         price_changed = old_price is not None and listing.get("price") is not None and int(old_price) != int(listing["price"])
-        cur.execute(
-            """
-            UPDATE listings_current
-            SET source=?, url=?, title=?, address=?, city=?, price=?, beds=?, baths=?, sqft=?,
-                assessed=?, desc_hash=?, last_seen=?, is_active=1, signature=?
-            WHERE listing_id=?;
-            """,
-            (
-                listing.get("source"),
-                listing.get("url"),
-                listing.get("title"),
-                listing.get("address"),
-                listing.get("city"),
-                listing.get("price"),
-                listing.get("beds"),
-                listing.get("baths"),
-                listing.get("sqft"),
-                listing.get("bc_assessed_value") or listing.get("assessed"),
-                desc_hash,
-                seen,
-                signature,
-                listing_id,
-            ),
-        )
-    else:
-        cur.execute(
-            """
-            INSERT INTO listings_current(
-                listing_id, source, url, title, address, city, price, beds, baths, sqft,
-                assessed, desc_hash, first_seen, last_seen, is_active, signature
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?);
-            """,
-            (
-                listing_id,
-                listing.get("source"),
-                listing.get("url"),
-                listing.get("title"),
-                listing.get("address"),
-                listing.get("city"),
-                listing.get("price"),
-                listing.get("beds"),
-                listing.get("baths"),
-                listing.get("sqft"),
-                listing.get("bc_assessed_value") or listing.get("assessed"),
-                desc_hash,
-                seen,
-                seen,
-                signature,
-            ),
-        )
 
-    conn.commit()
+    # Single UPSERT; first_seen is only set on insert.
+    cur.execute(
+        """
+        INSERT INTO listings_current(
+            listing_id, source, url, title, address, city, price, beds, baths, sqft,
+            assessed, first_seen, last_seen, is_active, signature
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT(listing_id) DO UPDATE SET
+            source=excluded.source, url=excluded.url, title=excluded.title, address=excluded.address,
+            city=excluded.city, price=excluded.price, beds=excluded.beds, baths=excluded.baths,
+            sqft=excluded.sqft, assessed=excluded.assessed, last_seen=excluded.last_seen,
+            is_active=1, signature=excluded.signature;
+        """,
+        (
+            listing_id,
+            listing.get("source"),
+            listing.get("url"),
+            listing.get("title"),
+            listing.get("address"),
+            listing.get("city"),
+            listing.get("price"),
+            listing.get("beds"),
+            listing.get("baths"),
+            listing.get("sqft"),
+            listing.get("bc_assessed_value") or listing.get("assessed"),
+            seen,
+            seen,
+            signature,
+        ),
+    )
+
+    # listing_prices holds one row per price the listing has had, for the 30-day drop query.
+    if listing.get("price") is not None and (old_price is None or price_changed):
+        cur.execute("INSERT INTO listing_prices(listing_id, ts, price) VALUES (?, ?, ?);", (listing_id, seen, listing["price"]))
+
+    current_map[listing_id] = {
+        "price": listing.get("price"),
+        "first_seen": first_seen,
+        "signature": signature,
+        "is_active": 1,
+        "last_seen": seen,
+    }
     return {"price_changed": price_changed, "old_price": old_price, "signature": signature}
 
 
-def record_event(conn: sqlite3.Connection, listing_id: str, event_type: str, old_value: str, new_value: str, event_time: Optional[dt.datetime] = None) -> None:
+def record_event(conn: sqlite3.Connection, listing_id: str, event_type: str, old_value: str, new_value: str, event_time: Optional[Timestamp] = None) -> None:
     conn.execute(
         "INSERT INTO listing_events(listing_id, event_time, event_type, old_value, new_value) VALUES (?, ?, ?, ?, ?);",
         (listing_id, _iso(event_time), event_type, str(old_value), str(new_value)),
     )
-    conn.commit()
 
 
-def mark_seen(conn: sqlite3.Connection, listing_id: str, seen_time: Optional[dt.datetime] = None) -> None:
+def record_events(conn: sqlite3.Connection, events: List[Tuple[str, str, object, object]], event_time: Optional[Timestamp] = None) -> None:
+    """Batch form of record_event for (listing_id, event_type, old_value, new_value) tuples."""
+    ts = _iso(event_time)
+    conn.executemany(
+        "INSERT INTO listing_events(listing_id, event_time, event_type, old_value, new_value) VALUES (?, ?, ?, ?, ?);",
+        [(listing_id, ts, event_type, str(old_value), str(new_value)) for listing_id, event_type, old_value, new_value in events],
+    )
+
+
+def record_presence(conn: sqlite3.Connection, listing_ids: List[str], seen_time: Optional[Timestamp] = None) -> None:
+    """Log presence rows only; upsert_listing_current already sets last_seen and is_active."""
     seen = _iso(seen_time)
-    conn.execute("INSERT INTO listing_presence(listing_id, seen_time) VALUES (?, ?);", (listing_id, seen))
-    conn.execute("UPDATE listings_current SET last_seen=?, is_active=1 WHERE listing_id=?;", (seen, listing_id))
-    conn.commit()
+    conn.executemany("INSERT INTO listing_presence(listing_id, seen_time) VALUES (?, ?);", [(lid, seen) for lid in listing_ids])
 
 
-def mark_missing(conn: sqlite3.Connection, listing_id: str, missing_time: Optional[dt.datetime] = None) -> None:
+def mark_missing(conn: sqlite3.Connection, listing_id: str, missing_time: Optional[Timestamp] = None) -> None:
     missing = _iso(missing_time)
     conn.execute("UPDATE listings_current SET is_active=0, last_seen=? WHERE listing_id=?;", (missing, listing_id))
-    record_event(conn, listing_id, "missing", None, "missing", missing_time)
+    record_event(conn, listing_id, "missing", None, "missing", missing)
 
 
-def get_listing_history(conn: sqlite3.Connection, listing_id: str, days: int = 90) -> List[Dict]:
-    cutoff = _iso(dt.datetime.utcnow() - dt.timedelta(days=days))
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT event_time, event_type, old_value, new_value FROM listing_events WHERE listing_id=? AND event_time >= ? ORDER BY event_time ASC;",
-        (listing_id, cutoff),
-    )
-    out = []
-    for event_time, event_type, old_value, new_value in cur.fetchall():
-        out.append(
-            {
-                "event_time": event_time,
-                "event_type": event_type,
-                "old_value": old_value,
-                "new_value": new_value,
-            }
-        )
-    return out
-
-
-def compute_dom_days(conn: sqlite3.Connection, listing_id: str, now: Optional[dt.datetime] = None) -> Optional[int]:
-    now = now or dt.datetime.utcnow()
-    cur = conn.cursor()
-    cur.execute("SELECT first_seen FROM listings_current WHERE listing_id=?;", (listing_id,))
-    row = cur.fetchone()
-    if not row or not row[0]:
+def _dom_from_first_seen(first_seen: Optional[str], now: dt.datetime) -> Optional[int]:
+    first_seen_dt = _parse_iso(first_seen)
+    if not first_seen_dt:
         return None
-    first_seen = _parse_iso(row[0])
-    if not first_seen:
-        return None
-    return max(0, (now - first_seen).days)
+    return max(0, (now - first_seen_dt).days)
 
 
-def compute_price_drop_30d(conn: sqlite3.Connection, listing_id: str, now: Optional[dt.datetime] = None) -> float:
+def compute_price_drop_30d(conn: sqlite3.Connection, listing_id: str, current_price: Optional[int], now: Optional[dt.datetime] = None) -> float:
     now = now or dt.datetime.utcnow()
+    current_price = current_price or 0
+    cutoff = _iso(now - dt.timedelta(days=30))
     cur = conn.cursor()
-    cur.execute("SELECT price FROM listings_current WHERE listing_id=?;", (listing_id,))
-    row = cur.fetchone()
-    if not row:
-        return 0.0
-    current_price = row[0] or 0
-    cutoff = now - dt.timedelta(days=30)
-    events = get_listing_history(conn, listing_id, days=30)
-
-    prices: List[float] = []
-    for ev in events:
-        if ev["event_type"] == "price_change":
-            try:
-                prices.append(float(ev["old_value"]))
-                prices.append(float(ev["new_value"]))
-            except (TypeError, ValueError):
-                continue
-    prices.append(float(current_price))
-
-    prices = [p for p in prices if p is not None]
-    if not prices:
-        return 0.0
-    max_price = max(prices)
+    # Prices set inside the window, plus the one already in effect when the window opened.
+    cur.execute(
+        """
+        SELECT MAX(price) FROM listing_prices
+        WHERE listing_id=? AND (
+            ts >= ? OR ts = (SELECT MAX(ts) FROM listing_prices WHERE listing_id=? AND ts < ?)
+        );
+        """,
+        (listing_id, cutoff, listing_id, cutoff),
+    )
+    peak = cur.fetchone()[0]
+    max_price = max(float(peak or 0), float(current_price))
     if max_price <= 0:
         return 0.0
     drop = (max_price - float(current_price)) / max_price
     return round(max(drop, 0.0), 4)
 
 
-def detect_relist(conn: sqlite3.Connection, listing_id: str, now: Optional[dt.datetime] = None) -> bool:
-    now = now or dt.datetime.utcnow()
-    cur = conn.cursor()
-    cur.execute("SELECT signature FROM listings_current WHERE listing_id=?;", (listing_id,))
-    sig_row = cur.fetchone()
-    if not sig_row or not sig_row[0]:
+def _detect_relist_cached(
+    listing_id: str,
+    current_map: Dict[str, Dict],
+    by_signature: Dict[str, List[str]],
+    last_missing: Dict[str, str],
+    now: dt.datetime,
+) -> bool:
+    """A listing counts as relisted if it went missing 7+ days ago, or if the most
+    recently seen other listing with the same signature is inactive."""
+    row = current_map.get(listing_id)
+    if not row or not row["signature"]:
         return False
-    signature = sig_row[0]
 
-    cur.execute(
-        "SELECT event_time FROM listing_events WHERE listing_id=? AND event_type='missing' ORDER BY event_time DESC LIMIT 1;",
-        (listing_id,),
-    )
-    missing_row = cur.fetchone()
-    if missing_row and missing_row[0]:
-        missing_time = _parse_iso(missing_row[0])
-        if missing_time and (now - missing_time).days >= 7:
+    missing_time = _parse_iso(last_missing.get(listing_id))
+    if missing_time and (now - missing_time).days >= 7:
+        return True
+
+    others = [current_map[oid] for oid in by_signature.get(row["signature"], []) if oid != listing_id]
+    if others:
+        latest = max(others, key=lambda r: r["last_seen"] or "")
+        if latest["is_active"] == 0:
             return True
+    return False
+
 
+def compute_signals_batch(conn: sqlite3.Connection, current_map: Dict[str, Dict], listing_ids: List[str], now: Optional[dt.datetime] = None) -> Dict[str, Tuple[int, float, bool]]:
+    """Return {listing_id: (dom_days, price_drop_30d, is_relist)} using a few bulk queries.
+
+    Expects current_map to reflect the upserts of the current pass.
+    """
+    now = now or dt.datetime.utcnow()
+    cur = conn.cursor()
     cur.execute(
-        "SELECT listing_id, is_active, last_seen FROM listings_current WHERE signature=? AND listing_id != ? ORDER BY last_seen DESC LIMIT 1;",
-        (signature, listing_id),
+        "SELECT DISTINCT listing_id FROM listing_events WHERE event_type='price_change' AND event_time >= ?;",
+        (_iso(now - dt.timedelta(days=30)),),
     )
-    other = cur.fetchone()
-    if other:
-        _other_id, other_active, other_last_seen = other
-        if other_active == 0:
-            if other_last_seen:
-                last_seen_dt = _parse_iso(other_last_seen)
-                if last_seen_dt and (now - last_seen_dt).days >= 7:
-                    return True
-            return True
-    return False
+    recent_price_changes = {row[0] for row in cur.fetchall()}
+    cur.execute("SELECT listing_id, MAX(event_time) FROM listing_events WHERE event_type='missing' GROUP BY listing_id;")
+    last_missing = {listing_id: event_time for listing_id, event_time in cur.fetchall()}
+
+    by_signature: Dict[str, List[str]] = {}
+    for lid, row in current_map.items():
+        if row["signature"]:
+            by_signature.setdefault(row["signature"], []).append(lid)
+
+    out: Dict[str, Tuple[int, float, bool]] = {}
+    for listing_id in listing_ids:
+        row = current_map.get(listing_id) or {}
+        dom_days = _dom_from_first_seen(row.get("first_seen"), now) or 0
+        price_drop = 0.0
+        if listing_id in recent_price_changes:
+            price_drop = compute_price_drop_30d(conn, listing_id, row.get("price"), now)
+        is_relist = _detect_relist_cached(listing_id, current_map, by_signature, last_missing, now)
+        out[listing_id] = (dom_days, price_drop, is_relist)
+    return out
@@ -6,7 +6,9 @@ Do not crawl aggressively. Use compliant sources or partner feeds for production
 from __future__ import annotations
 
 import datetime as dt
+import functools
 import hashlib
+import json
 import os
 import random
 import time
@@ -14,18 +16,44 @@ from typing import Dict, List, Optional
 from urllib.parse import urljoin
 from urllib.robotparser import RobotFileParser
 
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from requests.adapters import HTTPAdapter
 
 DEFAULT_USER_AGENT = "DealRadarMVP/0.1 (+https://example.com/)"
 CACHE_HOURS = 12
 
+# Compiled once; the search-page extractor runs these per card.
+_CARDS_XPATH = etree.XPath("//*[@data-listingid]")
+_PRICE_XPATH = etree.XPath("(.//*[contains(concat(' ', normalize-space(@class), ' '), ' price ') or @data-price])[1]")
+_LINK_XPATH = etree.XPath("(.//a[@href])[1]")
+_TEXT_XPATH = etree.XPath(".//text()[not(parent::script or parent::style)]")
+_UTF8_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+
+def _make_session() -> requests.Session:
+    """Shared session so repeated fetches reuse the TCP/TLS connection.
+
+    No automatic retries: every request goes through throttle() in http_get,
+    and a failed page is skipped rather than re-hit.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = _make_session()
+
 
 def throttle(min_s: float, max_s: float) -> None:
     delay = random.uniform(min_s, max_s)
     time.sleep(delay)
 
 
+@functools.lru_cache(maxsize=8)
 def fetch_robots_txt(base_url: str) -> Optional[RobotFileParser]:
     rp = RobotFileParser()
     rp.set_url(urljoin(base_url, "/robots.txt"))
@@ -47,39 +75,77 @@ def _cache_path(url: str, cache_dir: str) -> str:
     return os.path.join(cache_dir, fname)
 
 
-def http_get(url: str, headers: Optional[Dict] = None, timeout: int = 12, cache_dir: str = "cache", min_delay: float = 2.5, max_delay: float = 5.0) -> str:
+def _read_validators(path: str) -> Dict:
+    try:
+        with open(path + ".meta", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def http_get(url: str, headers: Optional[Dict] = None, timeout: int = 12, cache_dir: str = "cache", min_delay: float = 2.5, max_delay: float = 5.0, session: Optional[requests.Session] = None) -> str:
     os.makedirs(cache_dir, exist_ok=True)
     path = _cache_path(url, cache_dir)
     now = time.time()
-    if os.path.exists(path) and (now - os.path.getmtime(path)) < CACHE_HOURS * 3600:
+    cached = os.path.exists(path)
+    if cached and (now - os.path.getmtime(path)) < CACHE_HOURS * 3600:
         with open(path, "r", encoding="utf-8") as f:
             return f.read()
 
+    # Stale entry: revalidate with ETag / Last-Modified so an unchanged page costs a 304, not a full body.
+    req_headers = dict(headers or {"User-Agent": DEFAULT_USER_AGENT})
+    if cached:
+        validators = _read_validators(path)
+        if validators.get("etag"):
+            req_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            req_headers["If-Modified-Since"] = validators["last_modified"]
+
     throttle(min_delay, max_delay)
-    resp = requests.get(url, headers=headers or {"User-Agent": DEFAULT_USER_AGENT}, timeout=timeout)
+    resp = (session or _SESSION).get(url, headers=req_headers, timeout=timeout)
+    if cached and resp.status_code == 304:
+        os.utime(path, None)
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
     resp.raise_for_status()
     with open(path, "w", encoding="utf-8") as f:
         f.write(resp.text)
+    with open(path + ".meta", "w", encoding="utf-8") as f:
+        json.dump({"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}, f)
     return resp.text
 
 
+def _element_text(el) -> str:
+    return " ".join(t.strip() for t in _TEXT_XPATH(el) if t.strip())
+
+
 def _parse_listings_from_search(html: str) -> List[Dict]:
     """Very small extractor for proof-of-concept."""
-    soup = BeautifulSoup(html, "lxml")
+    if not html or not html.strip():
+        return []
+    try:
+        try:
+            tree = lxml.html.fromstring(html)
+        except ValueError:
+            # lxml rejects str input carrying an <?xml encoding=...?> declaration; parse
+            # UTF-8 bytes with the encoding pinned so the declaration is ignored.
+            tree = lxml.html.fromstring(html.encode("utf-8"), parser=_UTF8_HTML_PARSER)
+    except etree.ParserError:
+        return []
     out: List[Dict] = []
-    for card in soup.select("[data-listingid]"):
+    for card in _CARDS_XPATH(tree):
         try:
             listing_id = card.get("data-listingid")
-            title = card.get_text(" ", strip=True)[:140]
-            price_el = card.select_one(".price, [data-price]")
-            price_text = price_el.get_text(strip=True) if price_el else ""
+            title = _element_text(card)[:140]
+            price_els = _PRICE_XPATH(card)
+            price_text = _element_text(price_els[0]) if price_els else ""
             price = None
             if price_text:
                 digits = "".join(ch for ch in price_text if ch.isdigit())
                 if digits:
                     price = int(digits)
-            url_el = card.select_one("a[href]")
-            href = url_el["href"] if url_el else ""
+            url_els = _LINK_XPATH(card)
+            href = url_els[0].get("href") if url_els else ""
             out.append(
                 {
                     "listing_id": listing_id or hashlib.sha1(title.encode("utf-8")).hexdigest()[:12],